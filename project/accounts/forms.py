@@ -32,6 +32,8 @@ class RegistrationForm(UserCreationForm):
         if commit:
             user.save()
         user.profile.birthdate = self.cleaned_data['birthdate']
+        if commit:
+            user.profile.save(update_fields=['birthdate'])
         return user
 
 
@@ -99,8 +99,7 @@ class Profile(models.Model):
 
 
 @receiver(signal=post_save, sender=User)
-def create_or_update_user_profile(sender, instance, created, **kwargs):
-    """Create or update the user's profile if the user-object is saved"""
+def create_user_profile(sender, instance, created, **kwargs):
+    """Create the user's profile if the user-object is created"""
     if created:
         Profile.objects.create(user=instance)
-    instance.profile.save()
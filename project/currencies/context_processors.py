@@ -1,4 +1,5 @@
-from currencies.services import get_currency_by_language
+from currencies.models import Currency
+from currencies.services import get_currency_by_language, DEFAULT_CURRENCY, CurrencyObj
 
 
 class LazyObject:
@@ -14,8 +15,17 @@ class LazyObject:
         return getattr(self._wrapped, item)
 
 
+def get_local_currency(language: str) -> CurrencyObj:
+    # fall back to the default currency once per request,
+    # otherwise every displayed amount would look up the unknown currency again
+    try:
+        return get_currency_by_language(language)
+    except Currency.DoesNotExist:
+        return DEFAULT_CURRENCY
+
+
 def local_currency_processor(request):
     language = request.LANGUAGE_CODE
     return {
-        "LOCAL_CURRENCY": LazyObject(get_currency_by_language, language)
+        "LOCAL_CURRENCY": LazyObject(get_local_currency, language)
     }
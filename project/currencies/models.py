@@ -28,7 +28,7 @@ def get_rates(*codes: str) -> dict:
         if rate:
             result[currency_code.upper()] = rate
         else:
-            logger.warning(f"Failed to get currency rate: {currency_code}")
+            logger.warning("Failed to get currency rate: %s", currency_code)
     if not result[DEFAULT_CURRENCY] == 1:
         raise AssertionError(
             'Side API returned invalid values. '
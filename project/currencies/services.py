@@ -59,12 +59,16 @@ def create_currencies_from_settings(update_old_rates=True) -> None:
         update_rates(created_currencies, rates)
 
 
+def _get_currency_cache_key(code: currency_code_type) -> str:
+    return f'Currency_{code}'
+
+
 def get_currency_by_code(code: currency_code_type) -> CurrencyObj:
     if code == settings.DEFAULT_CURRENCY_CODE:
         return DEFAULT_CURRENCY
     else:
         currency = cache.get_or_set(
-            f'Currency_{code}',
+            _get_currency_cache_key(code),
             lambda: Currency.objects.filter(code=code).values('code', 'sym', 'rate').first(),
             3600
         )
@@ -84,11 +88,12 @@ def get_currency_by_language(language_str: str) -> CurrencyObj:
 
 def update_rates(codes: Iterable[str] = None, rates: dict = None, show_difference=False) -> None:
     old_rates = {}
-    if not codes:
-        codes = settings.EXTRA_CURRENCIES
+    codes = list(codes or settings.EXTRA_CURRENCIES)
     if show_difference:
         old_rates = Currency.objects.get_rates(codes)
     Currency.objects.update_rates(codes, rates=rates)
+    # cached currencies are reused for an hour, so drop them to display new rates at once
+    cache.delete_many([_get_currency_cache_key(code) for code in codes])
     if show_difference:
         new_rates = Currency.objects.get_rates(codes)
         for code, new_rate in new_rates.items():
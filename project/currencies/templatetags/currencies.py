@@ -2,8 +2,7 @@ import logging
 
 from django import template
 
-from currencies.models import Currency
-from currencies.services import _exchange, DEFAULT_CURRENCY, display_amount
+from currencies.services import DEFAULT_CURRENCY, display_amount
 
 register = template.Library()
 
@@ -15,10 +14,8 @@ def to_local_currency(context, amount):
     # WARNING! Use returned value only for displaying not as an operand
     if not amount:
         amount = 0
-    currency = context.get("LOCAL_CURRENCY")
-    try:
-        exchanged_amount = _exchange(amount, currency.rate)
-    except Currency.DoesNotExist:
-        currency = Currency(sym=DEFAULT_CURRENCY.sym)
-        exchanged_amount = amount
+    # the context processor always resolves a currency, but templates can be rendered without it
+    currency = context.get("LOCAL_CURRENCY", DEFAULT_CURRENCY)
+    # cents precision is enough to display an amount, so use floats instead of slower decimals
+    exchanged_amount = f'{float(amount) * float(currency.rate):.2f}'
     return display_amount(exchanged_amount, currency.sym)
@@ -1,10 +1,12 @@
 from decimal import Decimal
 
 from django.conf import settings
+from django.template import Context, Template
 from django.test import TestCase
 
 from currencies.services import (
-    get_currency_by_language, exchange_to, LOCAL_CURRENCIES, Currency, create_currencies_from_settings
+    get_currency_by_language, exchange_to, LOCAL_CURRENCIES, Currency, create_currencies_from_settings,
+    DEFAULT_CURRENCY, display_amount
 )
 
 
@@ -14,7 +16,8 @@ def create_currency(code, sym, rate):
 
 
 class CurrencyTest(TestCase):
-    def setUp(self) -> None:
+    @classmethod
+    def setUpTestData(cls):
         create_currencies_from_settings()
 
     def test_get_currency(self):
@@ -47,3 +50,8 @@ class CurrencyTest(TestCase):
         create_currency(code='TEST', sym='T', rate=rate_of_test_currency)
         exchanged_amount = exchange_to(settings.DEFAULT_CURRENCY_CODE, amount_to_exchange, _from='TEST')
         self.assertEqual(exchanged_amount, 20)
+
+    def test_display_default_currency_without_local_currency_in_context(self):
+        template = Template('{% load currencies %}{% to_local_currency amount %}')
+        rendered = template.render(Context({'amount': Decimal('12.5')}))
+        self.assertEqual(rendered, display_amount('12.50', DEFAULT_CURRENCY.sym))
@@ -136,7 +136,12 @@ class AddToCartForm(forms.Form):
         )
 
 
-class AgreementForm(forms.Form):
+class PurchaseAttemptMixin(forms.Form):
+    # generated when the paying page is rendered, so a resubmitted form doesn't pay twice
+    attempt_id = forms.UUIDField(widget=forms.HiddenInput, required=False)
+
+
+class AgreementForm(PurchaseAttemptMixin, forms.Form):
     agreement = forms.BooleanField(label=_('I am sure'), required=True)
 
 
@@ -147,6 +152,10 @@ class CreditCardForm(forms.Form):
         min_value=1000_0000_0000_0000, max_value=9999_9999_9999_9999)
 
 
+class PurchaseCreditCardForm(PurchaseAttemptMixin, CreditCardForm):
+    pass
+
+
 class TopUpForm(MoneyExchangerMixin, CreditCardForm):
     top_up_amount = forms.DecimalField(
         label=_('Top-up amount'),
@@ -5,6 +5,7 @@ from django.core.management.base import BaseCommand
 from django.db.models import Max, Model
 
 from market_app.models import *
+from market_app.services import reset_products_version
 
 
 class Command(BaseCommand):
@@ -18,6 +19,8 @@ class Command(BaseCommand):
             fill_with_settings()
         else:
             fill()
+        # products are created by bulk_create, which doesn't send signals resetting the cached products count
+        reset_products_version()
 
 
 def _zero_or_in(a, b):
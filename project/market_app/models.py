@@ -6,8 +6,9 @@ from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import User
 from django.core.validators import MinValueValidator, MaxValueValidator
-from django.db import models
-from django.db.models import F, QuerySet, Sum
+from django.db import models, transaction
+from django.db.models import F, QuerySet, Sum, ExpressionWrapper, DecimalField
+from django.db.models.functions import Round, Coalesce
 from django.urls import reverse_lazy
 from django.utils.translation import gettext_lazy as _
 
@@ -28,6 +29,39 @@ def validate_natural_number(number) -> None:
         raise ValueError(f'Expected a natural number, got {number} instead')
 
 
+def sale_price_expression(product_type_lookup: str = '') -> Round:
+    """
+    Return a db expression for ProductType.sale_price.
+    Pass a lookup to the product type if the expression is used on another model, e.g. 'product_type__'.
+    Databases round halves away from zero while Decimal rounds them to even,
+    so a price with half a cent can be one cent more than the python one.
+    """
+    lookup = product_type_lookup
+    product_sale_price = Round(ExpressionWrapper(
+        F(f'{lookup}product__original_price') * (100 - F(f'{lookup}product__discount_percent')) / 100,
+        output_field=DecimalField()
+    ), MONEY_DECIMAL_PLACES)
+    return Round(ExpressionWrapper(
+        product_sale_price * (100 + F(f'{lookup}markup_percent')) / 100,
+        output_field=DecimalField()
+    ), MONEY_DECIMAL_PLACES)
+
+
+def items_total_price_expression(order_items_lookup: str = '') -> Sum:
+    """
+    Return a db aggregate for the sum of OrderItem.total_price.
+    Pass a lookup to the order items if the aggregate is used on another model, e.g. 'items__'.
+    """
+    lookup = order_items_lookup
+    item_total_price = Coalesce(
+        f'{lookup}payment__amount',
+        ExpressionWrapper(
+            F(f'{lookup}amount') * sale_price_expression(f'{lookup}product_type__'), output_field=DecimalField()),
+        output_field=DecimalField()
+    )
+    return Sum(item_total_price)
+
+
 class OrderStatusChoices(Enum):
     UNPAID = _("awaiting for payment")
     CANCELED = _("canceled")
@@ -212,23 +246,28 @@ class ProductType(models.Model):
         status_code = ProductType.objects.filter(pk=self.pk).update(units_count=F('units_count') - quantity)
         return bool(status_code)
 
-    def take_units(self, expected_count: int, raise_exc_when_expected_count_gt_real_count=False) -> int:
+    def take_units(self, expected_count: int, raise_exc_when_expected_count_gt_real_count=False,
+                   commit: bool = True) -> int:
         """
         Decrease product_type units count by expected count
         and return count of taken units.
         Set raise_exc_when_expected_count_gt_real_count=True if it's necessary to raise error
         when real product type units count is smaller than expected count to take.
+        Set commit=False to decrease units count only on the instance and save it later, e.g. with bulk_update.
         """
-        real_count = self.units_count
         if expected_count < 1:
             return 0
-        elif real_count < expected_count:
+        real_count = self.units_count
+        if real_count < expected_count:
             if raise_exc_when_expected_count_gt_real_count:
                 raise ValueError(f"Cannot take {expected_count} there are only {real_count}")
             taken_units = real_count
         else:
             taken_units = expected_count
-        self.remove_product_units(taken_units)
+        if commit:
+            self.remove_product_units(taken_units)
+        else:
+            self.units_count -= taken_units
         return taken_units
 
     @property
@@ -287,14 +326,24 @@ class Cart(models.Model):
         if commit:
             self.save(update_fields=['items'])
 
+    def set_items(self, items: dict, commit: bool = True) -> None:
+        """Set several items at once and save the cart once. Nothing is changed if any quantity is invalid"""
+        for quantity in items.values():
+            validate_natural_number(quantity)
+        for product_type_pk, quantity in items.items():
+            self.set_item(product_type_pk, quantity, commit=False)
+        if commit:
+            self.save(update_fields=['items'])
+
     def clear(self) -> int:
+        self.items = self._default_cart_value()
         return Cart.objects.filter(pk=self.pk).update(items=self._default_cart_value())
 
     def _remove_own_products_and_nonexistent_types_from_cart(self) -> int:
         """Remove invalid items and return count of removed items"""
         items_count_at_start = len(self.items)
-        valid_types_pks = ProductType.objects.exclude(
-            product__market__owner_id=self.user_id).values_list('pk', flat=True)
+        valid_types_pks = set(ProductType.objects.filter(pk__in=list(self.items)).exclude(
+            product__market__owner_id=self.user_id).values_list('pk', flat=True))
         self.items = {pk: count for pk, count in self.items.items() if int(pk) in valid_types_pks}
         return items_count_at_start - len(self.items)
 
@@ -307,14 +356,16 @@ class Cart(models.Model):
     def is_filled(self) -> bool:
         return self.items != self._default_cart_value()
 
-    def prepare_items(self) -> int:
-        """Remove invalid items if filled, save valid items and return count of removed items"""
+    def prepare_items(self, commit: bool = True) -> int:
+        """
+        Remove invalid items if filled, save valid items and return count of removed items.
+        Set commit=False if valid items shouldn't be saved, e.g. if the cart will be cleared anyway.
+        """
         count_of_removed_items = 0
-        items_at_start = self.items.copy()
         if self.is_filled:
             count_of_removed_items += self._remove_own_products_and_nonexistent_types_from_cart()
             count_of_removed_items += self._remove_items_with_non_natural_number_as_count()
-            if items_at_start != self.items:
+            if commit and count_of_removed_items:
                 self.save(update_fields=['items'])
         return count_of_removed_items
 
@@ -335,7 +386,7 @@ class Balance(models.Model):
     )
 
     def get_operations_amount_sum(self) -> Decimal:
-        result = getattr(self.user, 'operations').aggregate(sum=Sum('amount'))['sum'] or Decimal('0.00')
+        result = Operation.objects.filter(user_id=self.user_id).aggregate(sum=Sum('amount'))['sum'] or Decimal('0.00')
         return result.quantize(Decimal('1.00'))
 
 
@@ -398,6 +449,15 @@ class Order(models.Model):
         max_length=200
     )
 
+    # Set by the caller of make_purchase, so a retried payment can be recognized without charging twice.
+    # It is only compared within its order, so it isn't unique: the client can send an id used by another order
+    purchase_attempt_id = models.UUIDField(
+        verbose_name=_('purchase attempt id'),
+        null=True,
+        blank=True,
+        editable=False
+    )
+
     class OrderError(Exception):
         pass
 
@@ -447,28 +507,38 @@ class Order(models.Model):
             coupon_discount = min(coupon_discount, coupon.discount_limit)
         return coupon_discount
 
-    def get_total_price_without_coupon_discount(self) -> Money:
-        total_price = 0
-        items = self.items.all()
-        for item in items:
-            total_price += item.total_price
-        return total_price
+    def get_total_price_without_coupon_discount(self, items: Iterable['OrderItem'] = None) -> Money:
+        """
+        Sum the prices of the passed items, e.g. already fetched ones, or count it with one db aggregate.
+        Orders annotated with items_total_price_expression('items__') as items_total_price don't make a query.
+        """
+        if items is not None:
+            total_price = sum(item.total_price for item in items)
+        elif hasattr(self, 'items_total_price'):
+            total_price = self.items_total_price
+        else:
+            total_price = self.items.aggregate(total_price=items_total_price_expression())['total_price']
+        return Decimal(total_price or 0).quantize(MONEY_DECIMAL_QUANTIZE)
 
-    def set_operation(self, operation_id):
+    def set_operation(self, operation_id, purchase_attempt_id=None) -> int:
+        """Save the operation to the order if it hasn't been paid yet and return count of updated rows"""
         self.operation_id = operation_id
+        self.purchase_attempt_id = purchase_attempt_id
+        return Order.objects.filter(pk=self.pk, operation__isnull=True).update(
+            operation_id=operation_id, purchase_attempt_id=purchase_attempt_id)
 
     def set_coupon(self, coupon_id: int) -> int:
         return Order.objects.filter(pk=self.pk).update(coupon_id=coupon_id)
 
+    @transaction.atomic
     def cancel(self):
         if self.has_paid:
             raise Order.CannotBeCancelledError("The order cannot be cancelled because of its status.")
-        items = self.items.select_related('product_type').only('pk', 'product_type', 'amount')
-        product_types = []
-        for item in items:
-            units_in_order = item.amount
-            item.product_type.units_count = F('units_count') + units_in_order
-            product_types.append(item.product_type)
+        # return the units with one UPDATE; product types are only needed as pks, so they are not fetched
+        product_types = [
+            ProductType(pk=product_type_id, units_count=F('units_count') + amount)
+            for product_type_id, amount in self.items.values_list('product_type_id', 'amount')
+        ]
         ProductType.objects.bulk_update(product_types, ['units_count'])
         self.delete()
 
@@ -479,8 +549,11 @@ class Order(models.Model):
 
     @property
     def total_price(self) -> Money:
+        return self.get_total_price()
+
+    def get_total_price(self, items: Iterable['OrderItem'] = None) -> Money:
         if not self.operation_id:
-            total_price = self.get_total_price_without_coupon_discount()
+            total_price = self.get_total_price_without_coupon_discount(items)
             if self.coupon_id:
                 coupon_discount = self.get_coupon_discount(total_price)
                 total_price -= coupon_discount
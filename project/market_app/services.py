@@ -1,15 +1,23 @@
 import logging
+from collections import defaultdict
 from decimal import Decimal
+from hashlib import md5
+from typing import Iterable
+from uuid import UUID, uuid4
 
-from django.core.exceptions import PermissionDenied
-from django.db import transaction
-from django.db.models import F, QuerySet
+from django.core.cache import cache
+from django.core.exceptions import PermissionDenied, EmptyResultSet
+from django.core.paginator import Paginator
+from django.db import transaction, connection
+from django.db.models import F, QuerySet, Prefetch, Case, When, DecimalField, Exists, OuterRef
+from django.utils.functional import cached_property
 
-from .models import Order, Operation, Cart, Coupon, OrderItem, Product, Money, Balance
+from .models import Order, Operation, Cart, Coupon, OrderItem, Product, Money, Balance, ProductType
 
 logger = logging.getLogger(__name__)
 SUBTRACT = '-'
 ADD = '+'
+PRODUCTS_VERSION_CACHE_KEY = 'products_version'
 
 
 class NotEnoughMoneyError(Exception):
@@ -23,50 +31,73 @@ def validate_money_amount(money_amount: Decimal) -> None:
         raise ValueError(f'Expected a positive number, got "{money_amount}" instead.')
 
 
+@transaction.atomic
 def prepare_order(cart: Cart) -> Order:
-    cart.prepare_items()
-    product_types = cart.get_cart_items()
+    # the cart is cleared by one update at the end, so there is no need to save its valid items
+    cart.prepare_items(commit=False)
+    # only units count is needed to take units, so don't join products here.
+    # Rows are locked to save new units counts with one bulk update
+    product_types = ProductType.objects.select_for_update().filter(pk__in=cart.get_types_pks()).only('units_count')
     order = Order.objects.create(user_id=cart.user_id)
-    order_items = []
-    for product_type in product_types:
-        expected_count = cart.get_count(product_type.pk)
-        if expected_count > 0:
-            taken_units = product_type.take_units(expected_count)
-            order_item = OrderItem(
-                order=order,
-                amount=taken_units,
-                product_type=product_type
-            )
-            order_items.append(order_item)
+    order_items = [
+        OrderItem(
+            order=order,
+            amount=product_type.take_units(cart.get_count(product_type.pk), commit=False),
+            product_type=product_type
+        ) for product_type in product_types
+    ]
+    ProductType.objects.bulk_update(product_types, fields=['units_count'])
     OrderItem.objects.bulk_create(order_items)
     cart.clear()
     return order
 
 
+def get_debt_to_sellers(order_items: Iterable[OrderItem]) -> dict:
+    """Return total payments of the order items grouped by seller id"""
+    debt_to_sellers = defaultdict(Decimal)
+    for payment in (item.payment for item in order_items):
+        debt_to_sellers[payment.user_id] += payment.amount
+    return dict(debt_to_sellers)
+
+
+def _create_operations(operations: list[Operation]) -> None:
+    """Save new operations and set their primary keys"""
+    if connection.features.can_return_rows_from_bulk_insert:
+        Operation.objects.bulk_create(operations)
+    else:
+        # primary keys aren't set by bulk_create on this database, but they are needed to link payments
+        for operation in operations:
+            operation.save()
+
+
 def _send_money_to_sellers(order: Order) -> None:
-    operations = []
-    order_items = order.items.only(
-        'amount', 'product_type__product__original_price', 'product_type__product__discount_percent',
-        'product_type__markup_percent', 'order__user__balance__amount',
-        'product_type__product__market__owner_id'
-    ).select_related(
-        'product_type', 'product_type__product', 'product_type__product__market', 'order__user__balance'
-    )
+    order_items = order.items.all()
+    payments = []
     for item in order_items:
-        seller_id = item.product_type.product.market.owner_id
+        seller_id = item.seller_id
         total_price = item.amount * item.product_type.sale_price
-        logger.info(
-            f'Transaction {total_price} '
-            f'from User(id={order.user_id}) to User(id={seller_id})'
-        )
-        operation = _change_balance_amount(seller_id, ADD, total_price, commit=True)
-        item.payment = operation
-        operations.append(operation)
+        logger.info('Transaction %s from User(id=%s) to User(id=%s)', total_price, order.user_id, seller_id)
+        payments.append(Operation(user_id=seller_id, amount=total_price))
+    _create_operations(payments)
+    for item, payment in zip(order_items, payments):
+        item.payment = payment
     OrderItem.objects.bulk_update(order_items, fields=['payment'])
-
-
-def check_if_user_can_use_order_coupon(order: Order) -> None:
-    if not Coupon.objects.filter(customers__exact=order.user_id, pk=order.coupon_id).exists():
+    debt_to_sellers = get_debt_to_sellers(order_items)
+    if not debt_to_sellers:
+        return
+    Balance.objects.filter(user_id__in=debt_to_sellers).update(amount=Case(
+        *(When(user_id=seller_id, then=F('amount') + debt) for seller_id, debt in debt_to_sellers.items()),
+        default=F('amount'),
+        output_field=DecimalField()
+    ))
+    logger.info('Sellers balances have been successfully changed. Amounts: %s', debt_to_sellers)
+
+
+def use_order_coupon(order: Order) -> None:
+    """Take the order coupon from the user's coupon set. Raise an error if the user doesn't have it."""
+    deleted_count, _ = Coupon.customers.through.objects.filter(
+        coupon_id=order.coupon_id, user_id=order.user_id).delete()
+    if not deleted_count:
         raise Coupon.CannotBeUsedError(
             f"User(id={order.user_id}) cannot use Coupon(id={order.coupon_id})"
         )
@@ -74,63 +105,141 @@ def check_if_user_can_use_order_coupon(order: Order) -> None:
 
 def _check_order_is_valid_for_purchasing(order: Order) -> None:
     """Check if order is ready for purchasing."""
-    order.refresh_from_db()
     if order.has_paid:
         raise PermissionDenied('Cannot pay twice for one order.')
     if order.is_empty():
         raise Order.EmptyOrderError('This order is empty.')
 
 
+def get_order_items_to_purchase() -> QuerySet[OrderItem]:
+    """Order items with everything make_purchase needs to pay sellers without additional queries"""
+    return OrderItem.objects.select_related('product_type__product').annotate(
+        seller_id=F('product_type__product__market__owner_id'))
+
+
+def _get_order_to_purchase(order: Order, reuse_prefetched_items: bool = False) -> Order:
+    """
+    Lock the order row until the end of the transaction, so it cannot be paid twice concurrently.
+    The passed order is reused if reuse_prefetched_items is set,
+    otherwise it is fetched again with everything make_purchase needs.
+    """
+    orders = Order.objects.select_for_update(of=('self',))
+    if reuse_prefetched_items:
+        # the fields that can be changed by other requests are refreshed from the locked row
+        order.operation_id, order.purchase_attempt_id, order.coupon_id = orders.values_list(
+            'operation_id', 'purchase_attempt_id', 'coupon_id').get(pk=order.pk)
+        return order
+    return orders.select_related('coupon').prefetch_related(
+        Prefetch('items', get_order_items_to_purchase())
+    ).get(pk=order.pk)
+
+
 @transaction.atomic
-def make_purchase(order: Order) -> Operation:
-    _check_order_is_valid_for_purchasing(order)
+def make_purchase(order: Order, attempt_id: UUID = None, reuse_prefetched_items: bool = False) -> Operation:
+    """
+    Pay for the order and return the purchase operation.
+    Pass the same attempt_id when retrying a payment: if the order has already been paid
+    with this attempt_id, its operation is returned instead of raising PermissionDenied.
+    Set reuse_prefetched_items only if the order items have been prefetched with get_order_items_to_purchase,
+    so they aren't fetched again.
+    """
+    order_to_purchase = _get_order_to_purchase(order, reuse_prefetched_items)
+    if attempt_id is None or order_to_purchase.purchase_attempt_id != attempt_id:
+        _check_order_is_valid_for_purchasing(order_to_purchase)
+        _purchase(order_to_purchase, attempt_id)
+    # keep the caller's instance in sync if the order has been fetched again
+    order.operation_id = order_to_purchase.operation_id
+    order.purchase_attempt_id = order_to_purchase.purchase_attempt_id
+    return order_to_purchase.operation
+
+
+def _purchase(order: Order, attempt_id: UUID = None) -> None:
     user_id = order.user_id
     if order.coupon_id:
-        check_if_user_can_use_order_coupon(order)
-        order.coupon.customers.remove(order.user_id)
-    total_order_price = order.total_price
-    logger.info(f'User(id={user_id}) try to pay for Order(id={order.pk}). Total order price: {total_order_price}')
+        use_order_coupon(order)
+    # count the total from the fetched items, so the user pays exactly what sellers get
+    total_order_price = order.get_total_price(order.items.all())
+    logger.info(
+        'User(id=%s) try to pay for Order(id=%s). Total order price: %s', user_id, order.pk, total_order_price)
     purchase_operation = _change_balance_amount(user_id, SUBTRACT, total_order_price)
     _send_money_to_sellers(order)
-    order.set_operation(purchase_operation.pk)
-    order.save()
-    return purchase_operation
+    if not order.set_operation(purchase_operation.pk, attempt_id):
+        raise PermissionDenied('Cannot pay twice for one order.')
+    order.operation = purchase_operation
 
 
-def _change_balance_amount(user_id, operation_type: str, amount_of_money: Decimal, commit=True) -> Operation:
-    validate_money_amount(amount_of_money)
-    balance = Balance.objects.get(user_id=user_id)
+def _change_balance_amount(user_id, operation_type: str, amount_of_money: Decimal) -> Operation:
+    # amount_of_money isn't validated here, callers that get it from outside must validate it themselves
+    balances = Balance.objects.filter(user_id=user_id)
     if operation_type == SUBTRACT:
-        if balance.amount < amount_of_money:
-            raise NotEnoughMoneyError(
-                f"User(id={user_id}) balance doesn't have enough money to the transaction"
-                f"Balance: {balance.amount}. Expected at least {amount_of_money}.")
+        # the balance is checked and changed by one statement, so it cannot be changed between check and update
+        balances = balances.filter(amount__gte=amount_of_money)
         amount_of_money = -amount_of_money
-    balance.amount = F('amount') + amount_of_money
     operation = Operation(user_id=user_id, amount=amount_of_money)
-    if commit:
-        balance.save(update_fields=['amount'])
-        operation.save()
-        logger.info(
-            f'User(id={user_id}) balance has been successfully changed. '
-            f'Amount: {amount_of_money}')
+    with transaction.atomic(savepoint=False):
+        is_changed = balances.update(amount=F('amount') + amount_of_money)
+        if is_changed:
+            operation.save()
+    if not is_changed:
+        if operation_type == SUBTRACT:
+            raise NotEnoughMoneyError(
+                f"User(id={user_id}) balance doesn't have enough money to the transaction. "
+                f"Expected at least {-amount_of_money}.")
+        raise Balance.DoesNotExist(f"User(id={user_id}) doesn't have a balance")
+    logger.info('User(id=%s) balance has been successfully changed. Amount: %s', user_id, amount_of_money)
     return operation
 
 
 def withdraw_money(user_id: int, amount_of_money: Money) -> Operation:
-    logger.info(f'Try to withdraw User(id={user_id}) balance. Amount: {amount_of_money}.')
+    logger.info('Try to withdraw User(id=%s) balance. Amount: %s.', user_id, amount_of_money)
+    validate_money_amount(amount_of_money)
     operation = _change_balance_amount(user_id, SUBTRACT, amount_of_money)
     return operation
 
 
 def top_up_balance(user_id: int, amount_of_money: Money) -> Operation:
-    logger.info(f"Try to top-up User(pk={user_id}) balance. Amount: {amount_of_money}.")
+    logger.info('Try to top-up User(pk=%s) balance. Amount: %s.', user_id, amount_of_money)
+    validate_money_amount(amount_of_money)
     operation = _change_balance_amount(user_id, ADD, amount_of_money)
     return operation
 
 
 def get_products(ordering: str = '-discount_percent') -> QuerySet[Product]:
-    fields = ('image', 'original_price', 'discount_percent', 'name', 'image')
-    queryset = Product.objects.distinct().only(*fields).filter(
-        available=True, product_types__isnull=False).order_by(ordering)
+    # only the fields used by the catalogue template, it doesn't touch any related objects
+    fields = ('image', 'original_price', 'discount_percent', 'name')
+    # EXISTS instead of joining product types, so rows don't have to be made distinct
+    has_types = Exists(ProductType.objects.filter(product_id=OuterRef('pk')))
+    queryset = Product.objects.only(*fields).filter(has_types, available=True).order_by(ordering)
     return queryset
+
+
+def get_products_version() -> str:
+    """Return a key that changes every time products or product types are changed"""
+    return cache.get_or_set(PRODUCTS_VERSION_CACHE_KEY, lambda: uuid4().hex, None)
+
+
+def reset_products_version() -> None:
+    cache.delete(PRODUCTS_VERSION_CACHE_KEY)
+
+
+class ProductsPaginator(Paginator):
+    """
+    Paginator that shares count of products between requests until products are changed.
+    The cached count is reset by post_save and post_delete signals of Product and ProductType,
+    so code that bypasses them (bulk_create, QuerySet.update, e.g. the test_filling command)
+    must call reset_products_version itself.
+    """
+    count_cache_timeout = 60
+
+    @cached_property
+    def count(self) -> int:
+        try:
+            sql, params = self.object_list.query.sql_with_params()
+        except EmptyResultSet:
+            return 0
+        query_hash = md5(f'{sql}{params}'.encode()).hexdigest()
+        return cache.get_or_set(
+            f'products_count_{get_products_version()}_{query_hash}',
+            self.object_list.count,
+            self.count_cache_timeout
+        )
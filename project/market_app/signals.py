@@ -1,12 +1,22 @@
 from django.contrib.auth.models import User
-from django.db.models.signals import post_save
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
 
-from .models import Cart, Balance
+from .models import Cart, Balance, Product, ProductType
+from .services import reset_products_version
 
 
 @receiver(signal=post_save, sender=User)
 def post_create_or_update_user(sender, instance, created, **kwargs):
     if created:
-        Balance.objects.create(user=instance)
-        Cart.objects.create(user=instance)
+        # a user must get both the balance and the cart or none of them
+        with transaction.atomic(savepoint=False):
+            Balance.objects.create(user_id=instance.pk)
+            Cart.objects.create(user_id=instance.pk)
+
+
+@receiver(signal=[post_save, post_delete], sender=Product)
+@receiver(signal=[post_save, post_delete], sender=ProductType)
+def post_change_products(sender, **kwargs):
+    reset_products_version()
@@ -1,7 +1,6 @@
 from django import template
-from django.core.paginator import Paginator
 
-from market_app.services import get_products
+from market_app.services import get_products, ProductsPaginator
 
 register = template.Library()
 
@@ -17,7 +16,7 @@ def product_search_form():
 
 
 def get_page_obj(request, queryset, page_size):
-    paginator = Paginator(queryset, page_size)
+    paginator = ProductsPaginator(queryset, page_size)
     page_number = request.GET.get('page') or 1
     page_obj = paginator.get_page(page_number)
     return paginator, page_obj
@@ -1,14 +1,12 @@
-import datetime
-
 from django.conf import settings
+from django.contrib.auth.hashers import make_password
 from django.contrib.auth.models import User
-from django.core.cache import cache
-from django.core.exceptions import ObjectDoesNotExist
+from django.db import transaction
 from django.db.models import Model, QuerySet
 from django.db.models.base import ModelBase
-from django.db.models.signals import post_save
-from django.test import TransactionTestCase
+from django.test import TestCase
 
+from accounts.models import Profile
 from currencies.models import Currency
 from market_app.models import Product, Market, ProductCategory, ProductType, Coupon, Cart, Balance, OrderItem, Order
 from market_app.services import prepare_order, top_up_balance, make_purchase
@@ -32,20 +30,22 @@ def assert_difference(expected_difference):
     return decorator
 
 
-class BaseTestCase(TransactionTestCase):
-    reset_sequences = True
+class BaseTestCase(TestCase):
     default_password = 'Pass4TestUser'  # password for all accounts
     _user = None
 
-    def tearDown(self) -> None:
-        cache.clear()
-
     def assertObjectDoesNotExist(self, query_set, **kwargs):
         """Fail if an object matching the given keyword arguments exists"""
         if isinstance(query_set, (Model, ModelBase)):
             query_set = query_set.objects
-        with self.assertRaises(ObjectDoesNotExist):
-            return query_set.get(**kwargs)
+        self.assertFalse(query_set.filter(**kwargs).exists())
+
+    def get_fetched_object(self, model, pk):
+        """Fetch an object once per test and return the same instance on later calls"""
+        fetched_objects = self.__dict__.setdefault('_fetched_objects', {})
+        if (model, pk) not in fetched_objects:
+            fetched_objects[model, pk] = model.objects.get(pk=pk)
+        return fetched_objects[model, pk]
 
     def log_in_as(self, user) -> bool:
         if not user.password:
@@ -63,26 +63,29 @@ class BaseTestCase(TransactionTestCase):
     def super_user(self):
         if not hasattr(self, '_super_user'):
             self._super_user = User.objects.create_superuser("TestSuperUser", password=self.default_password)
-        return User.objects.get(pk=self._super_user.pk)
+        return self._super_user
 
 
 class BaseMarketTestCase(BaseTestCase):
-    def setUp(self) -> None:
-        self._customer = self.create_customer()
-        self._seller = self.create_seller()
-        self._category = self.create_category()
-        self._market = self.create_market(owner=self.seller)
+    @classmethod
+    def setUpTestData(cls):
+        cls._customer = cls.create_customer()
+        cls._seller = cls.create_seller()
+        cls._category = cls.create_category()
+        cls._market = Market.objects.create(owner=cls._seller)
 
     @staticmethod
     def create_currencies():
         rates = {code: 50 for code in settings.EXTRA_CURRENCIES}
         rates[settings.DEFAULT_CURRENCY_CODE] = 1
-        for currency_code in settings.CURRENCIES:
-            Currency.objects.update_or_create(
-                code=currency_code,
-                sym=settings.CURRENCIES_SYMBOLS.get(currency_code, '?'),
-                rate=rates[currency_code]
-            )
+        currencies = [
+            Currency(code=code, sym=settings.CURRENCIES_SYMBOLS.get(code, '?'), rate=rates[code])
+            for code in settings.CURRENCIES
+        ]
+        created_codes = set(Currency.objects.filter(code__in=settings.CURRENCIES).values_list('code', flat=True))
+        Currency.objects.bulk_create([currency for currency in currencies if currency.code not in created_codes])
+        Currency.objects.bulk_update(
+            [currency for currency in currencies if currency.code in created_codes], fields=['sym', 'rate'])
 
     def log_in_as_customer(self) -> bool:
         return self.log_in_as(self.customer)
@@ -90,14 +93,16 @@ class BaseMarketTestCase(BaseTestCase):
     def log_in_as_seller(self) -> bool:
         return self.log_in_as(self.seller)
 
-    def create_customer(self, username='customer', password=None):
+    @classmethod
+    def create_customer(cls, username='customer', password=None):
         if password is None:
-            password = self.default_password
+            password = cls.default_password
         customer = User.objects.create_user(username=username, password=password)
         return customer
 
-    def create_seller(self, username='seller', password=None):
-        seller = self.create_customer(username=username, password=password)
+    @classmethod
+    def create_seller(cls, username='seller', password=None):
+        seller = cls.create_customer(username=username, password=password)
         return seller
 
     def create_market(self, **kwargs):
@@ -125,29 +130,43 @@ class BaseMarketTestCase(BaseTestCase):
         )
         return product
 
-    @staticmethod
-    def _init_users(id_list, name_prefix='user_'):
+    @classmethod
+    def _init_users(cls, id_ranges):
+        # id_ranges: {name_prefix: id_range}
+        # hash the password once for every user, so log_in_as doesn't have to set it
+        password = make_password(cls.default_password)
         users = User.objects.bulk_create(
-            objs=[User(id=i_id, username=f'{name_prefix}{i_id}') for i_id in id_list]
+            objs=[
+                User(id=i_id, username=f'{name_prefix}{i_id}', password=password)
+                for name_prefix, id_range in id_ranges.items() for i_id in id_range
+            ]
         )
-        for user in users:
-            post_save.send(user.__class__, instance=user, created=datetime.datetime.now())
+        cls._init_users_related_objects(users)
         return users
 
     @staticmethod
-    def _init_products(data):
+    def _init_users_related_objects(users):
+        # bulk_create does not send post_save, so create what its receivers would have created
+        Balance.objects.bulk_create([Balance(user_id=user.pk) for user in users])
+        Cart.objects.bulk_create([Cart(user_id=user.pk) for user in users])
+        Profile.objects.bulk_create([Profile(user_id=user.pk) for user in users])
+
+    @staticmethod
+    def _init_products(rows, original_price):
+        # rows: [(product_id, market_id, category_id), ...]
         products = [
             Product(
-                id=product_id,
-                name=f'product_{product_id}',
-                **values['product_data']
-            ) for product_id, values in data.items()]
+                id=product_id, name=f'product_{product_id}', market_id=market_id, category_id=category_id,
+                original_price=original_price
+            ) for product_id, market_id, category_id in rows
+        ]
         Product.objects.bulk_create(objs=products)
 
     @staticmethod
-    def _init_markets(sellers):
+    def _init_markets(id_range):
+        # every market has the same id as its owner
         markets = [
-            Market(id=seller.pk, name=f'market_{seller.pk}', owner=seller) for seller in sellers
+            Market(id=i_id, name=f'market_{i_id}', owner_id=i_id) for i_id in id_range
         ]
         Market.objects.bulk_create(markets)
         return markets
@@ -161,16 +180,17 @@ class BaseMarketTestCase(BaseTestCase):
         return categories
 
     @staticmethod
-    def _init_product_types(data):
-        types = []
-        for product_id, values in data.items():
-            for type_id, type_data in values['types_data'].items():
-                types.append(ProductType(product_id=product_id, id=type_id, **type_data))
+    def _init_product_types(rows):
+        # rows: [(type_id, product_id, units_count), ...]
+        types = [
+            ProductType(id=type_id, product_id=product_id, units_count=units_count)
+            for type_id, product_id, units_count in rows
+        ]
         ProductType.objects.bulk_create(types)
 
     def create_and_set_coupon(self, discount_percent=0, discount_limit=0) -> Coupon:
         coupon = Coupon.objects.create(discount_percent=discount_percent, discount_limit=discount_limit)
-        coupon.customers.add(self.user)
+        coupon.customers.add(self._user.id)
         return coupon
 
     @property
@@ -180,7 +200,7 @@ class BaseMarketTestCase(BaseTestCase):
 
     @property
     def market(self):
-        return Market.objects.get(owner=self.seller)
+        return Market.objects.get(owner_id=self._seller.pk)
 
     @property
     def markets(self):
@@ -192,15 +212,15 @@ class BaseMarketTestCase(BaseTestCase):
 
     @property
     def seller(self):
-        return User.objects.get(pk=self._seller.pk)
+        return self.get_fetched_object(User, self._seller.pk)
 
     @property
     def customer(self):
-        return User.objects.get(pk=self._customer.pk)
+        return self.get_fetched_object(User, self._customer.pk)
 
     @property
     def category(self):
-        return ProductCategory.objects.get(pk=self._category.pk)
+        return self.get_fetched_object(ProductCategory, self._category.pk)
 
     @property
     def customers(self):
@@ -223,162 +243,84 @@ class BaseMarketTestCase(BaseTestCase):
         return ProductType.objects.all()
 
     def get_order_items_that_ready_to_shipping(self) -> QuerySet[OrderItem]:
-        return OrderItem.objects.select_related(
-            'product_type', 'product_type__product', 'product_type__product__market', 'payment', 'order'
-        ).filter(payment__user_id=self.market.owner_id)
+        # the seller owns self.market, so there is no need to fetch the market to know its owner
+        return OrderItem.objects.select_related('product_type').only(
+            'is_shipped', 'product_type', 'product_type__properties'
+        ).filter(payment__user_id=self._seller.pk)
 
     @staticmethod
     def are_items_shipped(ids):
         return not OrderItem.objects.filter(id__in=ids, is_shipped=False).exists()
 
     def fill_cart(self, types_to_add):
-        cart = self.cart
-        for product_type_id, units_count in types_to_add.items():
-            cart.set_item(product_type_pk=product_type_id, quantity=units_count, commit=False)
-        cart.save()
+        self.cart.set_items(types_to_add)
 
-    def prepare_order(self, order_items: dict = None) -> Order:
+    def prepare_order(self, order_items: dict = None, user_id=None) -> Order:
         if order_items is None:
             order_items = {}
-        Cart.objects.filter(pk=self.cart.pk).update(items=order_items)
-        self._order = prepare_order(self.cart)
+        if user_id is None:
+            user_id = self._user.id
+        cart = Cart.objects.get(user_id=user_id)
+        cart.items = order_items
+        cart.save(update_fields=['items'])
+        self._order = prepare_order(cart)
         return self._order
 
 
 class TestBaseWithFilledCatalogue(BaseMarketTestCase):
     _default_product_price = 100
-    _product_data = {
-        # product_id: {**product_data}
-        '1': {
-            'product_data': {
-                'market_id': 1,
-                'category_id': 1,
-                'original_price': _default_product_price
-            },
-            'types_data': {
-                # type_id: {**product_type_data}
-                '1': {'units_count': 10},
-                '2': {'units_count': 5},
-                '3': {'units_count': 0}
-            }
-        },
-        '2': {
-            'product_data': {
-                'market_id': 1,
-                'category_id': 1,
-                'original_price': _default_product_price
-            },
-            'types_data': {
-                '4': {'units_count': 10},
-                '5': {'units_count': 5},
-                '6': {'units_count': 0}
-            }
-        },
-        '3': {
-            'product_data': {
-                'market_id': 2,
-                'category_id': 1,
-                'original_price': _default_product_price
-            },
-            'types_data': {
-                '7': {'units_count': 10},
-                '8': {'units_count': 5},
-                '9': {'units_count': 0}
-            }
-        },
-        '4': {
-            'product_data': {
-                'market_id': 2,
-                'category_id': 2,
-                'original_price': _default_product_price
-            },
-            'types_data': {
-                '10': {'units_count': 10},
-                '11': {'units_count': 5},
-                '12': {'units_count': 0}
-            }
-        },
-        '5': {
-            'product_data': {
-                'market_id': 3,
-                'category_id': 2,
-                'original_price': _default_product_price
-            },
-            'types_data': {
-                '13': {'units_count': 10},
-                '14': {'units_count': 5},
-                '15': {'units_count': 0}
-            }
-        },
-        '6': {
-            'product_data': {
-                'market_id': 3,
-                'category_id': 2,
-                'original_price': _default_product_price
-            },
-            'types_data': {
-                '16': {'units_count': 10},
-                '17': {'units_count': 5},
-                '18': {'units_count': 0}
-            }
-        },
-        '7': {
-            'product_data': {
-                'market_id': 4,
-                'category_id': 2,
-                'original_price': _default_product_price
-            },
-            'types_data': {
-                '19': {'units_count': 10},
-                '20': {'units_count': 5},
-                '21': {'units_count': 0}
-            }
-        },
-        '8': {
-            'product_data': {
-                'market_id': 4,
-                'category_id': 3,
-                'original_price': _default_product_price
-            },
-            'types_data': {
-                '22': {'units_count': 10},
-                '23': {'units_count': 5},
-                '24': {'units_count': 0}
-            }
-        },
-    }
+    # (product_id, market_id, category_id)
+    _product_rows = (
+        (1, 1, 1), (2, 1, 1), (3, 2, 1), (4, 2, 2),
+        (5, 3, 2), (6, 3, 2), (7, 4, 2), (8, 4, 3),
+    )
+    # (type_id, product_id, units_count)
+    _product_type_rows = (
+        (1, 1, 10), (2, 1, 5), (3, 1, 0),
+        (4, 2, 10), (5, 2, 5), (6, 2, 0),
+        (7, 3, 10), (8, 3, 5), (9, 3, 0),
+        (10, 4, 10), (11, 4, 5), (12, 4, 0),
+        (13, 5, 10), (14, 5, 5), (15, 5, 0),
+        (16, 6, 10), (17, 6, 5), (18, 6, 0),
+        (19, 7, 10), (20, 7, 5), (21, 7, 0),
+        (22, 8, 10), (23, 8, 5), (24, 8, 0),
+    )
     _categories_count = 3
     _sellers_count = 5
     _customers_count = 2
+    _seller_ids = range(1, _sellers_count + 1)
+    _customer_ids = range(_sellers_count + 1, _sellers_count + _customers_count + 1)
 
-    def setUp(self) -> None:
+    @classmethod
+    def setUpTestData(cls):
+        # the fixture uses hardcoded ids, so it must start from an empty database
         assert not User.objects.exists()
-        assert not ProductType.objects.exists()
-        assert not ProductCategory.objects.exists()
-        assert not Product.objects.exists()
-        assert not Market.objects.exists()
-        self._init_categories(range(1, self._categories_count + 1))
-        self._category = ProductCategory.objects.get(id=1)
-        sellers = self._init_users(range(1, 6), name_prefix='seller_')
-        self._init_markets(sellers)
-        self._seller = self.sellers.get(id=1)
-        self._init_products(self._product_data)
-        self._init_product_types(self._product_data)
-        self._init_users(
-            range(self._sellers_count + 1, self._sellers_count + self._customers_count + 1), name_prefix='customer_')
-        self._customer = self.customers.get(pk=6)
+        cls._init_categories(range(1, cls._categories_count + 1))
+        cls._category = ProductCategory.objects.get(id=1)
+        cls._init_users({'seller_': cls._seller_ids, 'customer_': cls._customer_ids})
+        cls._init_markets(cls._seller_ids)
+        cls._seller = User.objects.get(id=1)
+        cls._init_products(cls._product_rows, original_price=cls._default_product_price)
+        cls._init_product_types(cls._product_type_rows)
+        cls._customer = User.objects.get(pk=6)
+
+    @property
+    def sellers(self):
+        return User.objects.filter(pk__in=self._seller_ids)
+
+    @property
+    def customers(self):
+        return User.objects.filter(pk__in=self._customer_ids)
 
+    @transaction.atomic
     def _init_orders(self):
-        user_at_start = self._user
-        self.log_in_as(User.objects.get(username=f'customer_{self._sellers_count + 1}'))
-        top_up_balance(self.user.id, 10000)
-        self.order_1 = self.prepare_order({'1': 2, '3': 1})
+        # orders are prepared for the customers by id, so nobody has to log in
+        first_customer_id, second_customer_id = self._customer_ids
+        top_up_balance(first_customer_id, 10000)
+        self.order_1 = self.prepare_order({'1': 2, '3': 1}, user_id=first_customer_id)
         make_purchase(self.order_1)
-        self.order_2 = self.prepare_order({'1': 5, '3': 2, '5': 4, '8': 4})
+        self.order_2 = self.prepare_order({'1': 5, '3': 2, '5': 4, '8': 4}, user_id=first_customer_id)
         make_purchase(self.order_2)
-        self.log_in_as(User.objects.get(username=f'customer_{self._sellers_count + 2}'))
-        top_up_balance(self.user.id, 700)
-        self.order_3 = self.prepare_order({'4': 3, '13': 3})
+        top_up_balance(second_customer_id, 700)
+        self.order_3 = self.prepare_order({'4': 3, '13': 3}, user_id=second_customer_id)
         make_purchase(self.order_3)
-        if user_at_start:
-            self.log_in_as(user_at_start)
@@ -1,15 +1,12 @@
 from .base_case import BaseMarketTestCase, assert_difference, TestBaseWithFilledCatalogue
-from ..models import OrderStatusChoices, ProductType, Order
+from ..models import OrderStatusChoices, ProductType, Order, Cart, Product, items_total_price_expression
 from ..services import top_up_balance, withdraw_money, make_purchase, prepare_order
 
 
 class ProductTest(BaseMarketTestCase):
-    def setUp(self) -> None:
-        super(ProductTest, self).setUp()
-        self.product = self.create_product()
-
     def test_get_sale_price(self):
-        product = self.create_product(original_price=100, discount_percent=0)
+        # sale_price is computed in python, so the product doesn't have to be saved
+        product = Product(original_price=100, discount_percent=0)
         self.assertEqual(product.original_price, product.sale_price)
         product.discount_percent = 10
         self.assertNotEqual(product.original_price, product.sale_price)
@@ -34,7 +31,7 @@ class ProductTypeTest(BaseMarketTestCase):
 
     @property
     def product_type(self):
-        self._product_type.refresh_from_db()
+        self._product_type.refresh_from_db(fields=['units_count'])
         return self._product_type
 
     def assertUnitsCount(self, expected_count):
@@ -66,6 +63,14 @@ class ProductTypeTest(BaseMarketTestCase):
         self.assertEqual(taken_units, 10)
         self.assertUnitsCount(5)
 
+    def test_take_units_without_commit(self):
+        self.create_units(15)
+        product_type = self.product_type
+        taken_units = product_type.take_units(10, commit=False)
+        self.assertEqual(taken_units, 10)
+        self.assertEqual(product_type.units_count, 5)
+        self.assertUnitsCount(15)
+
     def test_flag_raise_exc_when_expected_count_gt_real_count(self):
         self.create_units(10)
         with self.assertRaises(ValueError):
@@ -99,10 +104,10 @@ class BalanceTest(BaseMarketTestCase):
 
     def test_balance_equals_amount_sum_of_user_operations(self):
         self.assertEqual(self.balance.get_operations_amount_sum(), 0)
-        top_up_balance(self.user.id, 100)
+        top_up_balance(self._user.id, 100)
         counted_sum = self.balance.get_operations_amount_sum()
         self.assertEqual(counted_sum, 100)
-        withdraw_money(self.user.id, 20)
+        withdraw_money(self._user.id, 20)
         counted_sum = self.balance.get_operations_amount_sum()
         self.assertEqual(counted_sum, 80)
 
@@ -113,7 +118,7 @@ class CartTest(TestBaseWithFilledCatalogue):
         self.log_in_as_customer()
 
     def check_data_to_compare(self):
-        return self.cart.items
+        return Cart.objects.values_list('items', flat=True).get(user_id=self._user.id)
 
     def test_cart_items_equal_default(self):
         items_at_start = self.cart.items
@@ -144,6 +149,11 @@ class CartTest(TestBaseWithFilledCatalogue):
         self.fill_cart({'1': 5, '7': 5, '11': 1})
         self.fill_cart({'1': 0, '7': 0})
 
+    @assert_difference({})
+    def test_set_items_does_not_change_cart_if_any_quantity_is_invalid(self):
+        with self.assertRaises(ValueError):
+            self.cart.set_items({'1': 5, '7': -1})
+
     @assert_difference({})
     def test_pass_adding_if_quantity_is_zero(self):
         self.cart.set_item('1', 0)
@@ -165,19 +175,17 @@ class CartTest(TestBaseWithFilledCatalogue):
         self.cart.set_item('2', 3)
         self.cart.set_item('256', 1)
         self.assertEqual(self.cart.items, {'2': 3, '256': 1})
-        count_of_removed_items = self.cart.prepare_items()
+        cart = self.cart
+        # one query to find the valid items and one to save them, whatever the cart size
+        with self.assertNumQueries(2):
+            count_of_removed_items = cart.prepare_items()
         self.assertEqual(count_of_removed_items, 1)
         self.assertEqual(self.cart.items, {'2': 3})
 
     @assert_difference({'10': 3, '7': 3})
     def test_remove_own_products_from_cart(self):
         self.log_in_as_seller()
-        self.cart.set_item('1', 5)
-        self.cart.set_item('3', 5)
-        self.cart.set_item('7', 3)
-        self.cart.set_item('5', 3)
-        self.cart.set_item('10', 3)
-        self.cart.set_item('2', 1)
+        self.cart.set_items({'1': 5, '3': 5, '7': 3, '5': 3, '10': 3, '2': 1})
         count_of_removed_items = self.cart.prepare_items()
         self.assertEqual(count_of_removed_items, 4)
 
@@ -188,22 +196,32 @@ class OrderTest(TestBaseWithFilledCatalogue):
         self.log_in_as_customer()
 
     def test_change_status(self):
-        top_up_balance(self.user.id, 10000)
+        top_up_balance(self._user.id, 10000)
         self.prepare_order({'1': 5, '3': 2, '5': 4, '8': 4})
         self.assertEqual(self.order.status, OrderStatusChoices.UNPAID.value)
         make_purchase(self.order)
-        self.order.refresh_from_db()
         self.assertEqual(self.order.status, OrderStatusChoices.HAS_PAID.value)
         self.order.items.update(is_shipped=True)
         self.assertEqual(self.order.status, OrderStatusChoices.SHIPPED.value)
 
+    def test_count_total_price_in_db(self):
+        order = self.prepare_order({'1': 5, '2': 3, '7': 5})
+        with self.assertNumQueries(1):
+            total_price = order.get_total_price_without_coupon_discount()
+        self.assertEqual(str(total_price), '1300.00')
+        self.assertEqual(total_price, order.get_total_price_without_coupon_discount(order.items.all()))
+        annotated_order = Order.objects.annotate(
+            items_total_price=items_total_price_expression('items__')).get(pk=order.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(annotated_order.get_total_price_without_coupon_discount(), total_price)
+        self.assertEqual(str(self.prepare_order({}).get_total_price_without_coupon_discount()), '0.00')
+
     @staticmethod
     def get_global_units_count(pks):
-        units_count = {}
-        for product_type in ProductType.objects.filter(id__in=pks):
-            pk = str(product_type.pk)
-            units_count[pk] = product_type.units_count
-        return units_count
+        return {
+            str(pk): units_count
+            for pk, units_count in ProductType.objects.filter(id__in=pks).values_list('pk', 'units_count')
+        }
 
     def test_can_cancel_order(self):
         self.fill_cart({'1': 3, '2': 5, '7': 2})
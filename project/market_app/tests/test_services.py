@@ -1,11 +1,16 @@
 from decimal import Decimal
+from uuid import uuid4
 
+from django.core.cache import cache
 from django.core.exceptions import PermissionDenied
+from django.db.models import Prefetch
+from django.test import override_settings
 
 from .base_case import TestBaseWithFilledCatalogue, BaseMarketTestCase, assert_difference
-from ..models import Order, ProductType, Operation, Coupon
+from ..models import Order, ProductType, Operation, Coupon, Balance
 from ..services import (
-    top_up_balance, make_purchase, withdraw_money, NotEnoughMoneyError, prepare_order
+    top_up_balance, make_purchase, withdraw_money, NotEnoughMoneyError, prepare_order, _get_order_to_purchase,
+    get_order_items_to_purchase, get_products, ProductsPaginator, reset_products_version
 )
 
 
@@ -15,70 +20,69 @@ def get_product_type(pk):
 
 class ChangeBalanceTest(BaseMarketTestCase):
     def setUp(self) -> None:
-        self._customer = self.create_customer()
-        self.log_in_as(self._customer)
+        self.log_in_as_customer()
 
     def check_data_to_compare(self):
-        return self.balance.amount
+        return Balance.objects.values_list('amount', flat=True).get(user_id=self._user.id)
 
     @assert_difference(100)
     def test_can_top_up(self):
-        top_up_balance(self.user.id, 100)
+        top_up_balance(self._user.id, 100)
 
     @assert_difference(200)
     def test_can_top_up_twice(self):
-        top_up_balance(self.user.id, 100)
-        top_up_balance(self.user.id, 100)
+        top_up_balance(self._user.id, 100)
+        top_up_balance(self._user.id, 100)
 
     def test_get_operation_object_if_topped_up(self):
-        operation = top_up_balance(self.user.id, 100)
+        operation = top_up_balance(self._user.id, 100)
         self.assertIsInstance(operation, Operation)
-        self.assertEqual(operation.user_id, self.user.id)
+        self.assertEqual(operation.user_id, self._user.id)
 
     def test_operation_amount_is_equal_top_up_amount(self):
-        operation = top_up_balance(self.user.id, 100)
+        operation = top_up_balance(self._user.id, 100)
         self.assertEqual(operation.amount, 100)
-        operation = top_up_balance(self.user.id, 50)
+        operation = top_up_balance(self._user.id, 50)
         self.assertEqual(operation.amount, 50)
 
     @assert_difference(0)
     def test_get_invalid_value(self):
         with self.assertRaises(TypeError):
-            top_up_balance(self.user.id, None)
+            top_up_balance(self._user.id, None)
         with self.assertRaises(ValueError):
-            top_up_balance(self.user.id, -100)
+            top_up_balance(self._user.id, -100)
 
     @assert_difference(Decimal('100.33'))
     def test_get_decimal_value(self):
-        top_up_balance(self.user.id, Decimal('100.33'))
+        top_up_balance(self._user.id, Decimal('100.33'))
 
     @assert_difference(0)
     def test_get_float(self):
         with self.assertRaises(TypeError):
-            top_up_balance(self.user.id, 3.33)
+            top_up_balance(self._user.id, 3.33)
 
     @assert_difference(50)
     def test_withdraw_money(self):
-        top_up_balance(self.user.id, 100)
-        withdraw_money(self.user.id, 50)
+        top_up_balance(self._user.id, 100)
+        withdraw_money(self._user.id, 50)
 
     @assert_difference(0)
     def test_withdraw_all_money(self):
-        top_up_balance(self.user.id, 100)
-        withdraw_money(self.user.id, 50)
-        withdraw_money(self.user.id, 50)
+        top_up_balance(self._user.id, 100)
+        withdraw_money(self._user.id, 50)
+        withdraw_money(self._user.id, 50)
 
     def test_get_operation_object_if_withdrew(self):
-        top_up_balance(self.user.id, 200)
-        operation = withdraw_money(self.user.id, 100)
+        top_up_balance(self._user.id, 200)
+        operation = withdraw_money(self._user.id, 100)
         self.assertIsInstance(operation, Operation)
-        self.assertEqual(operation.user_id, self.user.id)
+        self.assertEqual(operation.user_id, self._user.id)
 
     def test_operation_amount_is_negative_withdraw_amount(self):
-        top_up_balance(self.user.id, 200)
-        operation = withdraw_money(self.user.id, 100)
+        top_up_balance(self._user.id, 200)
+        operation = withdraw_money(self._user.id, 100)
         self.assertEqual(operation.amount, -100)
-        operation = withdraw_money(self.user.id, 50)
+        operation = withdraw_money(self._user.id, 50)
         self.assertEqual(operation.amount, -50)
 
 
@@ -89,20 +93,35 @@ class MakePurchaseTest(TestBaseWithFilledCatalogue):
 
     @property
     def sellers_balance(self):
-        return {seller.pk: seller.balance.amount for seller in self.sellers}
+        return dict(Balance.objects.filter(user_id__in=self._seller_ids).values_list('user_id', 'amount'))
 
     def test_sellers_get_money_after_purchase(self):
-        top_up_balance(self.user.id, 2000)
+        top_up_balance(self._user.id, 2000)
         units_to_buy = {'1': 5, '2': 3, '7': 5}
         self.fill_cart(units_to_buy)
         order = prepare_order(self.cart)
         make_purchase(order)
-        self.assertEqual(self.sellers.get(pk=1).balance.amount, 800)
-        self.assertEqual(self.sellers.get(pk=2).balance.amount, 500)
+        self.assertEqual(self.sellers_balance[1], 800)
+        self.assertEqual(self.sellers_balance[2], 500)
+        self.assertEqual(sum(self.sellers_balance.values()), 1300)
+
+    def test_purchase_refetches_items_prefetched_without_sellers(self):
+        top_up_balance(self._user.id, 2000)
+        self.fill_cart({'1': 5, '2': 3, '7': 5})
+        order = Order.objects.prefetch_related('items').get(pk=prepare_order(self.cart).pk)
+        operation = make_purchase(order)
+        self.assertEqual(order.operation_id, operation.pk)
         self.assertEqual(sum(self.sellers_balance.values()), 1300)
 
+    def test_order_to_purchase_is_fetched_with_its_items(self):
+        self.fill_cart({'1': 5, '2': 3, '7': 5})
+        order = _get_order_to_purchase(prepare_order(self.cart))
+        with self.assertNumQueries(0):
+            self.assertEqual(order.get_total_price_without_coupon_discount(order.items.all()), 1300)
+            self.assertEqual({item.seller_id for item in order.items.all()}, {1, 2})
+
     def test_customer_balance_reduced_after_purchase(self):
-        top_up_balance(self.user.id, 2000)
+        top_up_balance(self._user.id, 2000)
         units_to_buy = {'1': 5, '2': 3, '7': 5}
         self.fill_cart(units_to_buy)
         order = prepare_order(self.cart)
@@ -110,7 +129,7 @@ class MakePurchaseTest(TestBaseWithFilledCatalogue):
         self.assertEqual(self.balance.amount, 700)
 
     def test_will_cart_be_cleaned_after_purchase(self):
-        top_up_balance(self.user.id, 2000)
+        top_up_balance(self._user.id, 2000)
         self.assertEqual(self.user.cart.items, {})
         units_to_buy = {'1': 5, '2': 3, '7': 5}
         self.fill_cart(units_to_buy)
@@ -120,7 +139,7 @@ class MakePurchaseTest(TestBaseWithFilledCatalogue):
         self.assertEqual(self.user.cart.items, {})
 
     def test_raise_if_user_has_not_enough_money_to_purchase(self):
-        top_up_balance(self.user.id, 500)
+        top_up_balance(self._user.id, 500)
         units_to_buy = {'1': 5, '2': 3, '7': 5}
         self.fill_cart(units_to_buy)
         order = prepare_order(self.cart)
@@ -130,7 +149,7 @@ class MakePurchaseTest(TestBaseWithFilledCatalogue):
         self.assertEqual(sum(self.sellers_balance.values()), 0)
 
     def test_get_operation_object_after_purchase(self):
-        top_up_balance(self.user.id, 2000)
+        top_up_balance(self._user.id, 2000)
         units_to_buy = {'1': 5, '2': 3, '7': 5}
         self.fill_cart(units_to_buy)
         order = prepare_order(self.cart)
@@ -138,9 +157,21 @@ class MakePurchaseTest(TestBaseWithFilledCatalogue):
         operation = make_purchase(order)
         self.assertIsInstance(operation, Operation)
         self.assertEqual(operation.amount, -total_price)
+        self.assertEqual(order.operation_id, operation.pk)
+
+    def test_purchase_reuses_prefetched_order_items(self):
+        top_up_balance(self._user.id, 2000)
+        self.fill_cart({'1': 5, '2': 3, '7': 5})
+        order = Order.objects.prefetch_related(
+            Prefetch('items', get_order_items_to_purchase())).get(pk=prepare_order(self.cart).pk)
+        items = list(order.items.all())
+        operation = make_purchase(order, reuse_prefetched_items=True)
+        self.assertEqual(order.operation_id, operation.pk)
+        self.assertTrue(all(item.payment_id for item in items))
+        self.assertEqual(sum(self.sellers_balance.values()), 1300)
 
     def test_order_has_all_expected_items(self):
-        top_up_balance(self.user.id, 2000)
+        top_up_balance(self._user.id, 2000)
         units_to_buy = {'1': 5, '2': 3, '7': 5}
         self.fill_cart(units_to_buy)
         order = prepare_order(self.cart)
@@ -151,27 +182,39 @@ class MakePurchaseTest(TestBaseWithFilledCatalogue):
         self.assertEqual(purchased_units, units_to_buy)
 
     def test_cant_pay_twice_for_one_order(self):
-        top_up_balance(self.user.id, 2000)
+        top_up_balance(self._user.id, 2000)
         units_to_buy = {'1': 5}
         self.fill_cart(units_to_buy)
         order = prepare_order(self.cart)
         make_purchase(order)
         self.assertEqual(self.balance.amount, 1500)
-        self.assertEqual(self.sellers.get(pk=1).balance.amount, 500)
+        self.assertEqual(self.sellers_balance[1], 500)
         with self.assertRaises(PermissionDenied):
             make_purchase(order)
         self.assertEqual(self.balance.amount, 1500)
-        self.assertEqual(self.sellers.get(pk=1).balance.amount, 500)
+        self.assertEqual(self.sellers_balance[1], 500)
+
+    def test_retry_purchase_with_same_attempt_id(self):
+        top_up_balance(self._user.id, 2000)
+        self.fill_cart({'1': 5})
+        order = prepare_order(self.cart)
+        attempt_id = uuid4()
+        operation = make_purchase(order, attempt_id=attempt_id)
+        self.assertEqual(make_purchase(order, attempt_id=attempt_id), operation)
+        self.assertEqual(self.balance.amount, 1500)
+        self.assertEqual(self.sellers_balance[1], 500)
+        with self.assertRaises(PermissionDenied):
+            make_purchase(order, attempt_id=uuid4())
 
     def test_raise_error_if_order_is_empty(self):
-        top_up_balance(self.user.id, 2000)
+        top_up_balance(self._user.id, 2000)
         self.fill_cart({})
         order = prepare_order(self.cart)
         with self.assertRaises(Order.EmptyOrderError):
             make_purchase(order)
 
     def _test_use_coupon(self, coupon, expected_balance_amount):
-        top_up_balance(self.user.id, 2000)
+        top_up_balance(self._user.id, 2000)
         units_to_add = {'1': 5, '4': 1, '8': 4}
         order = self.prepare_order(units_to_add)
         order.set_coupon(coupon.pk)
@@ -189,15 +232,15 @@ class MakePurchaseTest(TestBaseWithFilledCatalogue):
     def test_coupon_dont_decrease_seller_income(self):
         coupon = self.create_and_set_coupon(discount_percent=10, discount_limit=80)
         self._test_use_coupon(coupon, 1080)
-        self.assertEqual(self.sellers.get(pk=1).balance.amount, 600)
-        self.assertEqual(self.sellers.get(pk=2).balance.amount, 400)
+        self.assertEqual(self.sellers_balance[1], 600)
+        self.assertEqual(self.sellers_balance[2], 400)
 
     def test_cannot_use_coupon_if_user_have_no_access_to_the_coupon(self):
         coupon = Coupon.objects.create(discount_percent=10, discount_limit=80)
         with self.assertRaises(Coupon.CannotBeUsedError):
             self._test_use_coupon(coupon, 2000)
-        self.assertEqual(self.sellers.get(pk=1).balance.amount, 0)
-        self.assertEqual(self.sellers.get(pk=2).balance.amount, 0)
+        self.assertEqual(self.sellers_balance[1], 0)
+        self.assertEqual(self.sellers_balance[2], 0)
 
     def test_remove_coupon_from_user_coupon_set_after_purchasing(self):
         coupon = self.create_and_set_coupon(discount_percent=10, discount_limit=80)
@@ -225,8 +268,54 @@ class PrepareOrderTest(TestBaseWithFilledCatalogue):
 
     def test_remove_own_products(self):
         self.log_in_as_seller()
-        top_up_balance(self.user.id, 2000)
+        top_up_balance(self._user.id, 2000)
         self.fill_cart({'1': 5, '7': 3})
         order = prepare_order(self.cart)
         self.assertEqual(len(order.items.all()), 1)
         self.assertEqual(order.items.first().product_type_id, 7)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class ProductsPaginatorTest(BaseMarketTestCase):
+    def setUp(self) -> None:
+        super(ProductsPaginatorTest, self).setUp()
+        cache.clear()
+        self.product = self.create_product()
+        self.product_type = self.product.create_product_type()
+
+    @staticmethod
+    def get_count():
+        return ProductsPaginator(get_products(), 10).count
+
+    def assertCachedCount(self, expected_count):
+        with self.assertNumQueries(1):
+            self.assertEqual(self.get_count(), expected_count)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.get_count(), expected_count)
+
+    def test_count_is_cached(self):
+        self.assertCachedCount(1)
+
+    def test_count_is_reset_after_saving_products(self):
+        self.assertCachedCount(1)
+        self.create_product().create_product_type()
+        self.assertCachedCount(2)
+        self.product.save()
+        self.assertCachedCount(2)
+
+    def test_count_is_reset_after_deleting_products(self):
+        self.assertCachedCount(1)
+        self.product_type.delete()
+        self.assertCachedCount(0)
+        self.create_product().create_product_type()
+        self.assertCachedCount(1)
+        self.product.delete()
+        self.assertCachedCount(1)
+
+    def test_bulk_create_does_not_reset_count(self):
+        product_without_types = self.create_product()
+        self.assertCachedCount(1)
+        ProductType.objects.bulk_create([ProductType(product=product_without_types)])
+        self.assertEqual(self.get_count(), 1)
+        reset_products_version()
+        self.assertCachedCount(2)
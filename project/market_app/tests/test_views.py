@@ -1,7 +1,8 @@
 from decimal import Decimal
+from uuid import uuid4
 
 from django.db.models import Q
-from django.test import TransactionTestCase
+from django.test import TestCase
 from django.urls import reverse_lazy
 
 from currencies.services import DEFAULT_CURRENCY_CODE, exchange_to
@@ -26,8 +27,7 @@ def prepare_product_data_to_post(data) -> dict:
     return data
 
 
-class ViewTestMixin(TransactionTestCase):
-    reset_sequences = True
+class ViewTestMixin(TestCase):
     ViewClass = None
     page_url = None
 
@@ -134,8 +134,12 @@ class ProductCreateTest(ViewTestMixin, BaseMarketTestCase):
     ViewClass = ProductCreateView
     page_url = reverse_lazy('market_app:create_product')
 
+    @classmethod
+    def setUpTestData(cls):
+        super(ProductCreateTest, cls).setUpTestData()
+        cls.create_currencies()
+
     def setUp(self) -> None:
-        self.create_currencies()
         super(ProductCreateTest, self).setUp()
         self.created_product = None
         self.product_data = {
@@ -205,8 +209,12 @@ class ProductEditTest(ViewTestMixin, BaseMarketTestCase):
     def get_url(self):
         return reverse_lazy('market_app:edit_product', kwargs={'pk': self.product.pk})
 
+    @classmethod
+    def setUpTestData(cls):
+        super(ProductEditTest, cls).setUpTestData()
+        cls.create_currencies()
+
     def setUp(self) -> None:
-        self.create_currencies()
         super(ProductEditTest, self).setUp()
         self.new_category = self.create_category('_ProductEditTest__NewCategoryName')
         self.old_data = {
@@ -591,9 +599,10 @@ class TopUpViewTest(ViewTestMixin, TestBaseWithFilledCatalogue):
     ViewClass = TopUpView
     page_url = reverse_lazy('market_app:top_up')
 
-    def setUp(self) -> None:
-        self.create_currencies()
-        super(TopUpViewTest, self).setUp()
+    @classmethod
+    def setUpTestData(cls):
+        super(TopUpViewTest, cls).setUpTestData()
+        cls.create_currencies()
 
     def test_redirect_if_not_logged_in(self):
         self._test_redirect_if_not_logged_in()
@@ -616,7 +625,6 @@ class TopUpViewTest(ViewTestMixin, TestBaseWithFilledCatalogue):
         data = self.get_top_up_form_data(1000)
         self.assertEqual(self.user.balance.amount, 0)
         response = self.post_to_page(data=data)
-        self.user.refresh_from_db()
         self.assertEqual(self.user.balance.amount, 1000)
         self.assertRedirects(response, self.ViewClass.success_url)
 
@@ -663,7 +671,8 @@ class PayingTest(ViewTestMixin, TestBaseWithFilledCatalogue):
         self.assertEqual(self.sellers.get(id=2).balance.amount, 0)
 
     def get_url(self):
-        return reverse_lazy('market_app:paying', kwargs={'pk': 1})
+        # pk=0 is never used by the database, so the page doesn't exist until the order is prepared
+        return reverse_lazy('market_app:paying', kwargs={'pk': self._order.pk if self._order else 0})
 
     def test_return_404_error_if_order_does_not_exist(self):
         response = self.get_from_page()
@@ -701,7 +710,7 @@ class PayingTest(ViewTestMixin, TestBaseWithFilledCatalogue):
 
     def test_cannot_post_if_logged_out(self):
         units_to_buy = {'1': 1}
-        top_up_balance(self.user.id, Decimal('32.13333'))
+        top_up_balance(self._user.id, Decimal('32.13333'))
         self.prepare_order(units_to_buy)
         self.client.logout()
         response = self.post_to_page(data=self.test_credit_cart_data)
@@ -709,15 +718,53 @@ class PayingTest(ViewTestMixin, TestBaseWithFilledCatalogue):
         self.assertIsNone(self.order.operation_id)
 
     def test_is_purchasing_successful(self):
-        top_up_balance(self.user.id, 10000)
+        top_up_balance(self._user.id, 10000)
         self.prepare_order({'1': 5, '2': 3, '7': 2})
         response = self.post_to_page(data=self.agreement_post_data)
         self.assertEqual(self.user.balance.amount, 9000)
         self.assertSuccessPurchase(self.order)
         self.assertRedirects(response, self.ViewClass.success_url)
 
+    def test_form_has_attempt_id(self):
+        self.prepare_order({'1': 1})
+        response = self.get_from_page()
+        self.assertIsNotNone(response.context['form'].initial['attempt_id'])
+        self.assertContains(response, 'name="attempt_id"')
+
+    def test_resubmitted_form_does_not_pay_twice(self):
+        top_up_balance(self._user.id, 10000)
+        self.prepare_order({'1': 5, '2': 3, '7': 2})
+        post_data = {**self.agreement_post_data, 'attempt_id': str(uuid4())}
+        self.post_to_page(data=post_data)
+        response = self.post_to_page(data=post_data)
+        self.assertRedirects(response, self.ViewClass.success_url)
+        self.assertEqual(self.user.balance.amount, 9000)
+        self.assertSuccessPurchase(self.order)
+        response = self.post_to_page(data={**post_data, 'attempt_id': str(uuid4())})
+        self.assertEqual(response.status_code, 404)
+
+    def test_attempt_id_of_another_order_does_not_break_purchase(self):
+        top_up_balance(self._user.id, 10000)
+        post_data = {**self.agreement_post_data, 'attempt_id': str(uuid4())}
+        self.prepare_order({'1': 5})
+        self.post_to_page(data=post_data)
+        self.prepare_order({'2': 3})
+        response = self.post_to_page(data=post_data)
+        self.assertRedirects(response, self.ViewClass.success_url)
+        self.assertSuccessPurchase(self.order)
+        self.assertEqual(self.user.balance.amount, 9200)
+
+    def test_permission_denied_for_paid_order_of_another_user(self):
+        top_up_balance(self._user.id, 10000)
+        self.prepare_order({'1': 5})
+        self.post_to_page(data=self.agreement_post_data)
+        self.assertTrue(self.order.has_paid)
+        self.assertTrue(self.log_in_as(User.objects.get(username='customer_7')))
+        response = self.post_to_page(data=self.agreement_post_data)
+        self.assertEqual(response.status_code, 403)
+
     def test_top_up_if_user_does_not_have_enough_money(self):
-        top_up_balance(self.user.id, 300)
+        top_up_balance(self._user.id, 300)
         self.assertEqual(self.balance.amount, 300)
         self.prepare_order({'1': 5, '7': 2})
         self.assertFalse(self.order.has_paid)
@@ -742,7 +789,7 @@ class OperationHistoryTest(ViewTestMixin, TestBaseWithFilledCatalogue):
     def setUp(self) -> None:
         super(OperationHistoryTest, self).setUp()
         self.log_in_as_customer()
-        top_up_balance(self.user.id, 10000)
+        top_up_balance(self._user.id, 10000)
         self.fill_cart({'1': 2, '3': 1, '7': 1})
         order = prepare_order(self.cart)
         make_purchase(order)
@@ -761,7 +808,7 @@ class OrderDetailTest(ViewTestMixin, TestBaseWithFilledCatalogue):
     def setUp(self) -> None:
         super(OrderDetailTest, self).setUp()
         self.log_in_as_customer()
-        top_up_balance(self.user.id, 10000)
+        top_up_balance(self._user.id, 10000)
         self.fill_cart({'1': 2, '3': 1, '5': 1})
         self._order = prepare_order(self.cart)
 
@@ -931,8 +978,10 @@ class UserCouponListTest(ViewTestMixin, BaseMarketTestCase):
         super(UserCouponListTest, self).setUp()
         coupons = [Coupon(discount_percent=10) for _ in range(5)]
         Coupon.objects.bulk_create(coupons)
-        Coupon.objects.get(pk=1).customers.add(self.customer.id)
-        Coupon.objects.get(pk=2).customers.add(self.customer.id)
+        # primary keys aren't reset between tests, so don't rely on them
+        self.coupon_pks = list(Coupon.objects.order_by('pk').values_list('pk', flat=True))
+        Coupon.objects.get(pk=self.coupon_pks[0]).customers.add(self.customer.id)
+        Coupon.objects.get(pk=self.coupon_pks[1]).customers.add(self.customer.id)
 
     def test_redirect_if_not_logged_in(self):
         self._test_redirect_if_not_logged_in()
@@ -944,11 +993,11 @@ class UserCouponListTest(ViewTestMixin, BaseMarketTestCase):
     def test_display_all_users_coupons(self):
         self.log_in_as_customer()
         response = self.get_from_page()
-        self.assertContains(response, 'id="coupon_1_block"')
-        self.assertContains(response, 'id="coupon_2_block"')
+        for pk in self.coupon_pks[:2]:
+            self.assertContains(response, f'id="coupon_{pk}_block"')
 
     def test_do_not_display_another_coupons(self):
         self.log_in_as_customer()
         response = self.get_from_page()
-        self.assertNotContains(response, 'id="coupon_3_block"')
-        self.assertNotContains(response, 'id="coupon_4_block"')
+        for pk in self.coupon_pks[2:]:
+            self.assertNotContains(response, f'id="coupon_{pk}_block"')
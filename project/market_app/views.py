@@ -1,5 +1,6 @@
 import json
 import re
+from uuid import uuid4
 
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
@@ -17,10 +18,11 @@ from currencies.models import Currency
 from currencies.services import get_currency_code_by_language, DEFAULT_CURRENCY_CODE, \
     get_exchanger
 from .forms import ProductForm, MarketForm, ProductUpdateForm, AddToCartForm, ProductTypeForm, CreditCardForm, \
-    AdvancedSearchForm, CartForm, CheckOutForm, TopUpForm, AgreementForm
-from .models import Product, Market, ProductType, Operation, Order, OrderItem, Coupon, Cart
+    AdvancedSearchForm, CartForm, CheckOutForm, TopUpForm, AgreementForm, PurchaseCreditCardForm
+from .models import Product, Market, ProductType, Operation, Order, OrderItem, Coupon, Cart, \
+    items_total_price_expression
 from .services import top_up_balance, make_purchase, prepare_order, \
-    get_products
+    get_products, get_order_items_to_purchase
 
 
 class MarketOwnerRequiredMixin(PermissionRequiredMixin):
@@ -260,6 +262,8 @@ class OrderDetail(PermissionRequiredMixin, generic.DetailView):
                     ).filter(order_id=order_pk).select_related(
                         'product_type', 'product_type__product', 'payment'
                     ))
+                ).annotate(
+                    items_total_price=items_total_price_expression('items__')
                 ).select_related('operation').get(pk=self.kwargs['pk'])
             except Order.DoesNotExist:
                 raise Http404(f"Order(pk={order_pk}) does not exists")
@@ -287,7 +291,7 @@ class OrderListView(generic.ListView):
                     'product_type', 'product_type__product'
                 )
             )
-        ).select_related('operation')
+        ).annotate(items_total_price=items_total_price_expression('items__')).select_related('operation')
 
 
 @login_required
@@ -326,7 +330,8 @@ class CheckOutView(PermissionRequiredMixin, generic.UpdateView):
 
     def get_context_data(self, **kwargs):
         context = super(CheckOutView, self).get_context_data(**kwargs)
-        total_price_without_coupon_discount = self.object.get_total_price_without_coupon_discount()
+        total_price_without_coupon_discount = self.object.get_total_price_without_coupon_discount(
+            self.object.items.all())
         context['total_price_without_coupon_discount'] = total_price_without_coupon_discount
         return context
 
@@ -342,25 +347,37 @@ class PayingView(LoginRequiredMixin, generic.FormView):
     def setup(self, request, *args, **kwargs):
         super(PayingView, self).setup(request, *args, **kwargs)
         self.unpaid_order: Order = Order.objects.prefetch_related(
-            Prefetch('items', OrderItem.objects.only(
+            # the items are reused by make_purchase, so they are fetched with the sellers ids
+            Prefetch('items', get_order_items_to_purchase().only(
                 'amount', 'order', 'product_type__markup_percent',
                 'product_type__product__discount_percent',
                 'product_type__product__original_price', 'payment_id'
-            ).select_related(
-                'product_type', 'product_type__product'
             ))
-        ).filter(
-            operation_id=None, pk=kwargs['pk']).first()
+        ).select_related('coupon').filter(pk=kwargs['pk']).first()
         if not self.unpaid_order:
             raise Http404(f"Order({kwargs['pk']}) does not exist")
+        # check the owner first, so other users cannot tell whether the order has been paid
         if self.unpaid_order.user_id != request.user.id:
             raise PermissionDenied()
-        self.total_order_price = self.unpaid_order.total_price
+        if self.unpaid_order.has_paid and not self.is_retried_purchase():
+            raise Http404(f"Order({kwargs['pk']}) does not exist")
+        self.total_order_price = self.unpaid_order.get_total_price(self.unpaid_order.items.all())
         self.top_up_amount = max(0, self.total_order_price - self.request.user.balance.amount)
 
-    def try_to_make_order(self):
+    def is_retried_purchase(self) -> bool:
+        attempt_id = self.unpaid_order.purchase_attempt_id
+        return self.request.method == 'POST' and attempt_id is not None and \
+            self.request.POST.get('attempt_id') == str(attempt_id)
+
+    def post(self, request, *args, **kwargs):
+        if self.unpaid_order.has_paid:
+            # the order has already been paid with the submitted attempt id
+            return HttpResponseRedirect(self.success_url)
+        return super(PayingView, self).post(request, *args, **kwargs)
+
+    def try_to_make_order(self, attempt_id=None):
         try:
-            make_purchase(self.unpaid_order)
+            make_purchase(self.unpaid_order, attempt_id, reuse_prefetched_items=True)
         except PermissionDenied as exc:
             raise exc
         except Order.EmptyOrderError:
@@ -375,9 +392,14 @@ class PayingView(LoginRequiredMixin, generic.FormView):
 
     def get_form_class(self):
         if self.top_up_amount:
-            return CreditCardForm
+            return PurchaseCreditCardForm
         return AgreementForm
 
+    def get_initial(self):
+        initial = super(PayingView, self).get_initial()
+        initial['attempt_id'] = uuid4()
+        return initial
+
     def get_template_names(self):
         if self.top_up_amount:
             return super(PayingView, self).get_template_names()
@@ -394,7 +416,7 @@ class PayingView(LoginRequiredMixin, generic.FormView):
         if isinstance(form, CreditCardForm):
             top_up_balance(self.request.user.id, self.top_up_amount)
             self.request.user.refresh_from_db()
-        return self.try_to_make_order()
+        return self.try_to_make_order(form.cleaned_data['attempt_id'])
 
 
 class TopUpView(LoginRequiredMixin, generic.FormView):